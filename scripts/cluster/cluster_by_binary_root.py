@@ -12,6 +12,8 @@ Inputs (default):
 Outputs (default):
   - outputs/clusters/binary_root_lemma_clusters.jsonl
   - outputs/clusters/binary_root_similarity_edges.csv
+    (within-group pairs with max(form_sim, meaning_sim) >= --edge-min-sim;
+    pass --edge-min-sim 0 for every pair)
 
 Notes:
   - This is discovery-first and intentionally simple. Later we can replace
@@ -24,15 +26,47 @@ from __future__ import annotations
 import argparse
 import csv
 import json
+import mmap
+import os
 import re
-from collections import defaultdict
+import stat
+import sys
+from array import array
+from collections import Counter, defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
 from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import chain, islice
+from json.encoder import encode_basestring as jstr
 from pathlib import Path
-from typing import Any, Iterable
+from sys import intern
+from typing import Any, Collection, Hashable, Iterable, Sequence
 
 
 AR_DIACRITICS_RE = re.compile(r"[\u064B-\u065F\u0670\u0640]")
 WS_RE = re.compile(r"\s+")
+# Deletes diacritics, tatweel and all whitespace (what `\s` matches) in a single
+# `str.translate` pass; equivalent to the diacritic/whitespace regexes above.
+_AR_STRIP_TABLE = dict.fromkeys(
+    [*range(0x064B, 0x0660), 0x0670, 0x0640, *(cp for cp in range(0x3001) if chr(cp).isspace())]
+)
+
+FEATURE_CACHE_SIZE = 200_000
+WRITE_BUFFER = 1 << 20
+WRITE_BATCH = 4096
+WIN32_MAX_WORKERS = 61
+# Groups kept in flight per pool worker; bounds how many finished results wait to be written.
+POOL_WINDOW_PER_WORKER = 4
+
+# One row of the similarity edges CSV: binary_root, src_lemma, dst_lemma, form_sim, meaning_sim.
+EdgeRow = tuple[str, str, str, str, str]
+
+# process_group output: (cluster JSONL lines, edge CSV rows) for one binary_root.
+GroupResult = tuple[list[str], list[EdgeRow]]
+
+# Sparse within-group similarities: (i, j) with i < j -> score. Missing pairs score 0.0.
+PairSims = dict[tuple[int, int], float]
 
 
 def strip_arabic_diacritics(text: str) -> str:
@@ -45,41 +79,72 @@ def norm_text(text: str) -> str:
     return text
 
 
-def char_ngrams(text: str, *, n: int = 2) -> set[str]:
-    text = strip_arabic_diacritics(norm_text(text))
-    text = text.replace(" ", "")
-    if len(text) < n:
-        return {text} if text else set()
-    return {text[i : i + n] for i in range(0, len(text) - n + 1)}
+# Lemma and gloss strings repeat across records (several sources/stages per word),
+# so feature extraction is memoized per distinct string; results are shared and
+# therefore frozen.
+@lru_cache(maxsize=FEATURE_CACHE_SIZE)
+def char_bigram_ids(text: str) -> frozenset[int]:
+    """
+    Character bigrams of `text` with diacritics, tatweel and whitespace removed,
+    each packed into one int as (cp1 << 21) | cp2.
+
+    Code points fit in 21 bits, so the packing is bijective. A text shorter
+    than two characters pairs its code point with 0x1FFFFF, which is never a
+    code point, so it cannot collide with a real bigram.
+    """
+    text = (text or "").translate(_AR_STRIP_TABLE)
+    if len(text) < 2:
+        return frozenset({(ord(text) << 21) | 0x1FFFFF} if text else ())
+    codes = list(map(ord, text))
+    return frozenset([(a << 21) | b for a, b in zip(codes, codes[1:])])
+
+
+@lru_cache(maxsize=FEATURE_CACHE_SIZE)
+def token_set(text: str) -> frozenset[str]:
+    text = norm_text(text).lower()
+    if not text:
+        return frozenset()
+    return frozenset([t for t in re.split(r"[^0-9a-zA-Z\u0600-\u06FF]+", text) if t])
 
 
-def jaccard(a: set[str], b: set[str]) -> float:
-    if not a and not b:
-        return 0.0
-    if not a or not b:
-        return 0.0
-    inter = len(a & b)
-    union = len(a | b)
-    return float(inter) / float(union) if union else 0.0
+def _iter_jsonl_lines(lines: Iterable[bytes]) -> Iterable[dict[str, Any]]:
+    loads = json.loads
+    for line in lines:
+        text = line.decode("utf-8", "replace")
+        # Universal newlines, as in text mode: a lone \r also ends a record.
+        # Raw CR cannot occur inside a valid JSON string, so splitting is safe.
+        for part in text.split("\r") if "\r" in text else (text,):
+            # str.strip (Unicode whitespace, as the text-mode reader did) both skips
+            # blank lines and trims non-JSON whitespace such as \xa0 around a record
+            part = part.strip()
+            if part:
+                yield loads(part)
 
 
-def token_set(text: str) -> set[str]:
-    text = norm_text(text).lower()
-    if not text:
-        return set()
-    return {t for t in re.split(r"[^0-9a-zA-Z\u0600-\u06FF]+", text) if t}
+def iter_jsonl(path: Path) -> Iterable[dict[str, Any]]:
+    # Regular files are read through a read-only mmap (no file buffer rebuilds,
+    # RSS stays flat on large inputs); lines are decoded leniently, once each.
+    with path.open("rb") as fh:
+        st = os.fstat(fh.fileno())
+        if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from _iter_jsonl_lines(iter(mm.readline, b""))
+        else:
+            # pipes/FIFOs (/dev/stdin, <(zcat ...)) report size 0 and cannot be
+            # mapped, nor can empty files; iterate the file object instead
+            yield from _iter_jsonl_lines(fh)
 
 
-def iter_jsonl(path: Path) -> Iterable[dict[str, Any]]:
-    with path.open("r", encoding="utf-8", errors="replace") as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue
-            yield json.loads(line)
+def _first(rec: dict[str, Any], *keys: str) -> str:
+    # str(rec.get(a) or rec.get(b) or "").strip(), without the repeated chain
+    for k in keys:
+        v = rec.get(k)
+        if v:
+            return v.strip() if type(v) is str else str(v).strip()
+    return ""
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class LemmaRow:
     lemma: str
     language: str
@@ -95,8 +160,9 @@ class LemmaRow:
 
 class DSU:
     def __init__(self, n: int) -> None:
-        self.parent = list(range(n))
-        self.rank = [0] * n
+        # packed C ints; ranks stay below log2(n) so int8 is plenty
+        self.parent = array("i", range(n))
+        self.rank = array("b", bytes(n))
 
     def find(self, x: int) -> int:
         while self.parent[x] != x:
@@ -117,20 +183,51 @@ class DSU:
             self.parent[rb] = ra
             self.rank[ra] += 1
 
-
-def cluster_indices(sim_matrix: list[list[float]], *, threshold: float) -> list[int]:
-    n = len(sim_matrix)
+    def union_all(self, pairs: Iterable[tuple[int, int]]) -> None:
+        # Same as calling union() per pair, with find/union inlined over local
+        # references; this is the per-group hot loop.
+        parent = self.parent
+        rank = self.rank
+        for a, b in pairs:
+            while parent[a] != a:
+                parent[a] = a = parent[parent[a]]
+            while parent[b] != b:
+                parent[b] = b = parent[parent[b]]
+            if a == b:
+                continue
+            if rank[a] < rank[b]:
+                parent[a] = b
+            elif rank[a] > rank[b]:
+                parent[b] = a
+            else:
+                parent[b] = a
+                rank[a] += 1
+
+
+def cluster_indices(feats: Sequence[Collection[Hashable]], sims: PairSims, *, threshold: float) -> list[int | None]:
+    """
+    Union rows whose similarity meets `threshold` and return compact cluster ids.
+
+    Rows with an empty feature set (no usable lemma / no gloss) have nothing to
+    compare and get `None` rather than a singleton cluster of their own.
+    """
+    n = len(feats)
     dsu = DSU(n)
-    for i in range(n):
-        for j in range(i + 1, n):
-            if sim_matrix[i][j] >= threshold:
-                dsu.union(i, j)
-    roots = [dsu.find(i) for i in range(n)]
+    if threshold <= 0:
+        # every pair scores >= 0, including pairs absent from the sparse map
+        live = [i for i, f in enumerate(feats) if f]
+        dsu.union_all(zip(live, live[1:]))
+    else:
+        dsu.union_all(pair for pair, sim in sims.items() if sim >= threshold)
     # map root -> compact cluster id
     root_to_cluster: dict[int, int] = {}
     next_id = 0
-    out: list[int] = []
-    for r in roots:
+    out: list[int | None] = []
+    for i, f in enumerate(feats):
+        if not f:
+            out.append(None)
+            continue
+        r = dsu.find(i)
         cid = root_to_cluster.get(r)
         if cid is None:
             cid = next_id
@@ -140,24 +237,112 @@ def cluster_indices(sim_matrix: list[list[float]], *, threshold: float) -> list[
     return out
 
 
-def build_similarity(rows: list[LemmaRow]) -> tuple[list[list[float]], list[list[float]]]:
-    # form: char bigram jaccard on lemma (Arabic script)
-    # meaning: token jaccard on gloss (or empty)
-    form_feats = [char_ngrams(r.lemma, n=2) for r in rows]
+def jaccard_pairs(feats: Sequence[Collection[Hashable]]) -> PairSims:
+    """
+    Sparse all-pairs Jaccard over feature sets, computed as an X @ X.T product.
+
+    Features are mapped to column ids once (a CSR-style row -> columns layout),
+    then each row's intersection counts are accumulated over the posting lists
+    of its columns with `Counter`, which does the counting at C level. Pairs
+    sharing no feature are never visited and are absent from the result
+    (their similarity is 0.0).
+    """
+    if len(feats) < 2:
+        return {}
+    vocab: dict[Hashable, int] = {}
+    row_cols: list[list[int]] = []
+    postings: list[list[int]] = []
+    for i, f in enumerate(feats):
+        cols = []
+        for feat in f:
+            col = vocab.get(feat)
+            if col is None:
+                col = vocab[feat] = len(postings)
+                postings.append([])
+            postings[col].append(i)
+            cols.append(col)
+        row_cols.append(cols)
+
+    sizes = [len(cols) for cols in row_cols]
+    sims: PairSims = {}
+    for i, cols in enumerate(row_cols):
+        if not cols:
+            continue
+        size_i = sizes[i]
+        counts = Counter(chain.from_iterable(postings[c] for c in cols))
+        for j, k in counts.items():
+            if j > i:
+                sims[(i, j)] = float(k) / float(size_i + sizes[j] - k)
+    return sims
+
+
+def build_features(rows: list[LemmaRow]) -> tuple[list[frozenset[int]], list[frozenset[str]]]:
+    # form: char bigrams on lemma (Arabic script), packed as ints
+    # meaning: tokens on gloss (or empty)
+    form_feats = [char_bigram_ids(r.lemma) for r in rows]
     meaning_feats = [token_set(r.gloss) for r in rows]
+    return form_feats, meaning_feats
 
+
+def jint(value: int | None) -> str:
+    return "null" if value is None else str(value)
+
+
+def cluster_row_prefix(br: str) -> str:
+    # Leading part of every cluster row in a group; built once per group, not per row.
+    return f'{{"binary_root": {jstr(br)}, "lemma": '
+
+
+def cluster_row_json(prefix: str, r: LemmaRow, form_cluster: int | None, meaning_cluster: int | None) -> str:
+    # Fixed schema, so format directly instead of going through json.dumps;
+    # byte-identical to json.dumps(..., ensure_ascii=False) with default separators.
+    return (
+        f'{prefix}{jstr(r.lemma)}, "root_norm": {jstr(r.root_norm)}, '
+        f'"form_cluster": {jint(form_cluster)}, "meaning_cluster": {jint(meaning_cluster)}, '
+        f'"language": {jstr(r.language)}, "stage": {jstr(r.stage)}, "script": {jstr(r.script)}, '
+        f'"source": {jstr(r.source)}}}\n'
+    )
+
+
+def process_group(
+    br: str, rows: list[LemmaRow], *, form_threshold: float, meaning_threshold: float, edge_min_sim: float
+) -> GroupResult:
+    """
+    Subcluster one binary_root group; returns (cluster JSONL lines, edge CSV rows).
+
+    Pure function of its inputs so groups can be farmed out to worker processes;
+    writing stays with the caller.
+    """
+    form_feats, meaning_feats = build_features(rows)
+    form_sim = jaccard_pairs(form_feats)
+    meaning_sim = jaccard_pairs(meaning_feats)
+    form_clusters = cluster_indices(form_feats, form_sim, threshold=form_threshold)
+    meaning_clusters = cluster_indices(meaning_feats, meaning_sim, threshold=meaning_threshold)
+
+    # Per-lemma cluster assignments
+    prefix = cluster_row_prefix(br)
+    cluster_lines = [
+        cluster_row_json(prefix, r, form_clusters[idx], meaning_clusters[idx]) for idx, r in enumerate(rows)
+    ]
+
+    # Similarity edges for inspection: pairs whose best score reaches edge_min_sim.
+    # Pairs sharing no feature score 0.0 on both and are absent from the sparse maps,
+    # so for a positive cutoff only those keys need checking; 0 keeps every pair.
     n = len(rows)
-    form_sim = [[0.0] * n for _ in range(n)]
-    meaning_sim = [[0.0] * n for _ in range(n)]
-    for i in range(n):
-        form_sim[i][i] = 1.0
-        meaning_sim[i][i] = 1.0
-        for j in range(i + 1, n):
-            fs = jaccard(form_feats[i], form_feats[j])
-            ms = jaccard(meaning_feats[i], meaning_feats[j])
-            form_sim[i][j] = form_sim[j][i] = fs
-            meaning_sim[i][j] = meaning_sim[j][i] = ms
-    return form_sim, meaning_sim
+    if edge_min_sim > 0:
+        pairs: Iterable[tuple[int, int]] = sorted(form_sim.keys() | meaning_sim.keys())
+    else:
+        pairs = ((i, j) for i in range(n) for j in range(i + 1, n))
+    edge_rows: list[EdgeRow] = []
+    lemmas = [r.lemma for r in rows]
+    for pair in pairs:
+        fs = form_sim.get(pair, 0.0)
+        ms = meaning_sim.get(pair, 0.0)
+        if fs < edge_min_sim and ms < edge_min_sim:
+            continue
+        i, j = pair
+        edge_rows.append((br, lemmas[i], lemmas[j], f"{fs:.6f}", f"{ms:.6f}"))
+    return cluster_lines, edge_rows
 
 
 def main() -> None:
@@ -167,6 +352,8 @@ def main() -> None:
     ap.add_argument("--form-threshold", type=float, default=0.55, help="Within-binary_root threshold for form subclusters.")
     ap.add_argument("--meaning-threshold", type=float, default=0.35, help="Within-binary_root threshold for meaning subclusters (requires gloss/definition).")
     ap.add_argument("--max-group", type=int, default=400, help="Skip similarity+subclustering for very large binary_root groups.")
+    ap.add_argument("--edge-min-sim", type=float, default=0.1, help="Only write edges where form_sim or meaning_sim reaches this value (0 = all pairs).")
+    ap.add_argument("--workers", type=int, default=0, help="Worker processes for per-group subclustering (0 = one per CPU, 1 = in-process; capped at 61 on Windows). Up to 4 groups per worker are in flight at once.")
     args = ap.parse_args()
 
     if not args.input.exists():
@@ -181,96 +368,86 @@ def main() -> None:
     total_in = 0
     for rec in iter_jsonl(args.input):
         total_in += 1
-        br = str(rec.get("binary_root") or "").strip()
+        br = _first(rec, "binary_root")
         if not br:
             continue
+        # low-cardinality fields are interned so rows share one string object each
+        br = intern(br)
         groups[br].append(
             LemmaRow(
-                lemma=str(rec.get("lemma") or "").strip(),
-                language=str(rec.get("language") or "").strip(),
-                script=str(rec.get("script") or "").strip(),
-                stage=str(rec.get("stage") or "").strip(),
-                source=str(rec.get("source") or "").strip(),
-                root_norm=str(rec.get("root_norm") or rec.get("root") or "").strip(),
+                lemma=_first(rec, "lemma"),
+                language=intern(_first(rec, "language")),
+                script=intern(_first(rec, "script")),
+                stage=intern(_first(rec, "stage")),
+                source=intern(_first(rec, "source")),
+                root_norm=_first(rec, "root_norm", "root"),
                 binary_root=br,
-                translit=str(rec.get("translit") or "").strip(),
-                ipa=str(rec.get("ipa") or rec.get("ipa_raw") or "").strip(),
-                gloss=str(rec.get("gloss_plain") or rec.get("gloss") or rec.get("definition") or "").strip(),
+                translit=_first(rec, "translit"),
+                ipa=_first(rec, "ipa", "ipa_raw"),
+                gloss=_first(rec, "gloss_plain", "gloss", "definition"),
             )
         )
 
     edge_fieldnames = ["binary_root", "src_lemma", "dst_lemma", "form_sim", "meaning_sim"]
     wrote_rows = 0
     wrote_edges = 0
-
-    with clusters_out.open("w", encoding="utf-8") as out_f, edges_out.open("w", encoding="utf-8", newline="") as edges_f:
-        edges_w = csv.DictWriter(edges_f, fieldnames=edge_fieldnames)
-        edges_w.writeheader()
-
-        for br, rows in sorted(groups.items(), key=lambda kv: (kv[0], len(kv[1]))):
-            if not rows:
-                continue
-            if len(rows) > int(args.max_group):
+    # cluster rows are collected and flushed in bulk rather than written one by one
+    batch: list[str] = []
+
+    max_group = int(args.max_group)
+    workers = int(args.workers) or os.cpu_count() or 1
+    if sys.platform == "win32":
+        # ProcessPoolExecutor raises ValueError for max_workers > 61 on Windows
+        workers = min(workers, WIN32_MAX_WORKERS)
+
+    with ExitStack() as stack:
+        out_f = stack.enter_context(clusters_out.open("w", encoding="utf-8", buffering=WRITE_BUFFER))
+        edges_f = stack.enter_context(edges_out.open("w", encoding="utf-8", newline="", buffering=WRITE_BUFFER))
+        edges_w = csv.writer(edges_f)
+        edges_w.writerow(edge_fieldnames)
+
+        ordered = [(br, groups[br]) for br in sorted(groups) if groups[br]]
+        small = [(br, rows) for br, rows in ordered if len(rows) <= max_group]
+        process = partial(
+            process_group,
+            form_threshold=float(args.form_threshold),
+            meaning_threshold=float(args.meaning_threshold),
+            edge_min_sim=float(args.edge_min_sim),
+        )
+        use_pool = workers > 1 and len(small) > 1
+        if use_pool:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            window = POOL_WINDOW_PER_WORKER * workers
+            ahead = iter(small)  # same binary_root order as writing
+            pending: dict[str, Future[GroupResult]] = {}
+
+        for br, rows in ordered:
+            if len(batch) >= WRITE_BATCH:
+                out_f.writelines(batch)
+                batch.clear()
+            if len(rows) > max_group:
                 # emit rows without subclusters for huge groups (discovery safety)
-                for r in rows:
-                    out_f.write(
-                        json.dumps(
-                            {
-                                "binary_root": br,
-                                "lemma": r.lemma,
-                                "root_norm": r.root_norm,
-                                "form_cluster": None,
-                                "meaning_cluster": None,
-                                "language": r.language,
-                                "stage": r.stage,
-                                "script": r.script,
-                                "source": r.source,
-                            },
-                            ensure_ascii=False,
-                        )
-                        + "\n"
-                    )
-                    wrote_rows += 1
+                prefix = cluster_row_prefix(br)
+                batch.extend(cluster_row_json(prefix, r, None, None) for r in rows)
+                wrote_rows += len(rows)
                 continue
 
-            form_sim, meaning_sim = build_similarity(rows)
-            form_clusters = cluster_indices(form_sim, threshold=float(args.form_threshold))
-            meaning_clusters = cluster_indices(meaning_sim, threshold=float(args.meaning_threshold))
-
-            # Emit per-lemma cluster assignments
-            for idx, r in enumerate(rows):
-                out_f.write(
-                    json.dumps(
-                        {
-                            "binary_root": br,
-                            "lemma": r.lemma,
-                            "root_norm": r.root_norm,
-                            "form_cluster": int(form_clusters[idx]),
-                            "meaning_cluster": int(meaning_clusters[idx]),
-                            "language": r.language,
-                            "stage": r.stage,
-                            "script": r.script,
-                            "source": r.source,
-                        },
-                        ensure_ascii=False,
-                    )
-                    + "\n"
-                )
-                wrote_rows += 1
-
-            # Emit similarity edges for inspection (all pairs)
-            for i in range(len(rows)):
-                for j in range(i + 1, len(rows)):
-                    edges_w.writerow(
-                        {
-                            "binary_root": br,
-                            "src_lemma": rows[i].lemma,
-                            "dst_lemma": rows[j].lemma,
-                            "form_sim": f"{form_sim[i][j]:.6f}",
-                            "meaning_sim": f"{meaning_sim[i][j]:.6f}",
-                        }
-                    )
-                    wrote_edges += 1
+            if use_pool:
+                # Only the next `window` groups (in write order) are in flight, so at most
+                # that many finished results wait in memory. Each refill is submitted
+                # largest first (LPT) so long jobs start early and don't straggle.
+                fresh = list(islice(ahead, window - len(pending)))
+                for fbr, frows in sorted(fresh, key=lambda kv: -len(kv[1])):
+                    pending[fbr] = pool.submit(process, fbr, frows)
+                cluster_lines, edge_rows = pending.pop(br).result()
+            else:
+                cluster_lines, edge_rows = process(br, rows)
+            batch.extend(cluster_lines)
+            wrote_rows += len(cluster_lines)
+            edges_w.writerows(edge_rows)
+            wrote_edges += len(edge_rows)
+
+        out_f.writelines(batch)
 
     print(f"Read {total_in} rows, grouped into {len(groups)} binary_root buckets.")
     print(f"Wrote clusters: {clusters_out} (rows={wrote_rows})")